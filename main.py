@@ -5,20 +5,28 @@
 """
 
 import os
+import sys
+import csv
 import asyncio
 import json
+import argparse
+import signal
+import tempfile
+import functools
+import tracemalloc
 import random
+import time
 import logging
 import sqlite3
 from datetime import datetime, timedelta
-from typing import Dict, List, Set
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
 import aiohttp
 from pathlib import Path
 
 # Импорты aiogram
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from aiogram.utils import executor
 from aiogram.dispatcher.filters import Command
 
 # ============================================================================
@@ -34,10 +42,32 @@ if not TELEGRAM_TOKEN:
 # Имя бота (можно изменить)
 BOT_NAME = os.environ.get('BOT_NAME', 'Бот Историка')
 
+# JSON-файл со списком ботов для запуска нескольких ботов в одном процессе:
+# [{"token": "...", "name": "...", "tenant": "...", "post_hour": 9,
+#   "post_minute": 0, "send_interval": 0.5, "personality": "..."}]
+# "tenant" - ключ строк бота в общей базе. Если его нет, первый бот списка
+# получает '' (данные, накопленные до перехода на BOTS_CONFIG), остальные - свой ID.
+# Без BOTS_CONFIG запускается один бот с TELEGRAM_TOKEN и BOT_NAME
+BOTS_CONFIG = os.environ.get('BOTS_CONFIG', '')
+
+# Путь к общей базе данных
+DB_PATH = os.environ.get('DB_PATH', 'chats.db')
+
+# Соединения общего пула для отправок и запросов к API генерации. Каждый бот
+# держит ещё одно соединение под long-poll getUpdates (до 60 с), поэтому
+# итоговый лимит пула - HTTP_POOL_SIZE + число ботов
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '100'))
+
 # API ключи (опционально)
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
 HF_TOKEN = os.environ.get('HF_TOKEN', '')
 
+# Сколько секунд при остановке ждать завершения текущих отправок и обработчиков
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get('SHUTDOWN_DRAIN_TIMEOUT', '30'))
+
+# Сколько дней хранить построчную историю отправок (сводная статистика хранится всегда)
+SENT_POSTS_RETENTION_DAYS = int(os.environ.get('SENT_POSTS_RETENTION_DAYS', '7'))
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -53,42 +83,154 @@ logger = logging.getLogger(__name__)
 # БАЗА ДАННЫХ ДЛЯ ХРАНЕНИЯ ЧАТОВ
 # ============================================================================
 
+# Колонки таблиц для импорта/экспорта: (имя, тип), первыми идут ключевые.
+# Колонка tenant не выгружается: файл всегда относится к одному боту
+TRANSFER_TABLES = {
+    'chats': {
+        'columns': [
+            ('chat_id', int),
+            ('chat_title', str),
+            ('chat_type', str),
+            ('added_date', str),
+            ('is_active', int),
+            ('last_post_date', str),
+            ('settings', str),
+        ],
+        'key': ('chat_id',),
+        # Значения по умолчанию для колонок, которых нет в записи файла
+        'defaults': {'is_active': 1, 'settings': '{}'},
+    },
+    'sent_posts': {
+        'columns': [
+            ('post_date', str),
+            ('chat_id', int),
+            ('post_hash', str),
+        ],
+        'key': ('post_date', 'chat_id'),
+        'defaults': {},
+    },
+}
+
+# NULL в CSV (пустая ячейка - это пустая строка), как в COPY PostgreSQL
+CSV_NULL = '\\N'
+
+# Размер пачки для executemany при импорте
+IMPORT_CHUNK_SIZE = 5000
+
+def _moscow_now() -> datetime:
+    """Текущее московское время (UTC+3) - даты в базе считаются по Москве"""
+    return datetime.utcnow() + timedelta(hours=3)
+
 class ChatDatabase:
-    """Управление базой данных чатов"""
+    """Управление базой данных чатов
     
-    def __init__(self, db_path: str = 'chats.db'):
+    Одна база может обслуживать несколько ботов: все строки помечены
+    колонкой tenant, а экземпляр класса видит только строки своего бота.
+    """
+    
+    def __init__(self, db_path: str = DB_PATH, tenant: str = ''):
         self.db_path = db_path
+        self.tenant = tenant
         self._init_db()
     
     def _init_db(self):
         """Инициализация базы данных"""
         with sqlite3.connect(self.db_path) as conn:
+            # Транзакцией управляем сами: без этого sqlite3 фиксирует DDL
+            # (RENAME/CREATE) сразу, и сбой посреди миграции оставил бы данные
+            # в *_legacy
+            conn.isolation_level = None
             cursor = conn.cursor()
+            cursor.execute('BEGIN')
+            try:
+                self._create_tables(cursor)
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+    
+    def _create_tables(self, cursor: sqlite3.Cursor):
+        """Создание таблиц и перенос данных из схемы для одного бота"""
+        # Таблицы без колонки tenant (из версии для одного бота) пересоздаются
+        legacy_tables = []
+        for table in ('chats', 'sent_posts', 'delivery_stats'):
+            cursor.execute(f'PRAGMA table_info({table}_legacy)')
+            legacy_columns = [row[1] for row in cursor.fetchall()]
+            if legacy_columns:
+                # Остаток прерванной миграции прошлых версий - доносим его
+                legacy_tables.append((table, legacy_columns))
+                continue
             
-            # Таблица чатов
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chats (
-                    chat_id INTEGER PRIMARY KEY,
-                    chat_title TEXT,
-                    chat_type TEXT,
-                    added_date TEXT,
-                    is_active INTEGER DEFAULT 1,
-                    last_post_date TEXT,
-                    settings TEXT DEFAULT '{}'
-                )
-            ''')
-            
-            # Таблица отправленных постов (чтобы не дублировать)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS sent_posts (
-                    post_date TEXT,
-                    chat_id INTEGER,
-                    post_hash TEXT,
-                    PRIMARY KEY (post_date, chat_id)
-                )
-            ''')
-            
-            conn.commit()
+            cursor.execute(f'PRAGMA table_info({table})')
+            columns = [row[1] for row in cursor.fetchall()]
+            if columns and 'tenant' not in columns:
+                cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_legacy')
+                legacy_tables.append((table, columns))
+        
+        # Таблица чатов
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chats (
+                tenant TEXT NOT NULL DEFAULT '',
+                chat_id INTEGER,
+                chat_title TEXT,
+                chat_type TEXT,
+                added_date TEXT,
+                is_active INTEGER DEFAULT 1,
+                last_post_date TEXT,
+                settings TEXT DEFAULT '{}',
+                PRIMARY KEY (tenant, chat_id)
+            )
+        ''')
+        
+        # Таблица отправленных постов (чтобы не дублировать)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sent_posts (
+                tenant TEXT NOT NULL DEFAULT '',
+                post_date TEXT,
+                chat_id INTEGER,
+                post_hash TEXT,
+                PRIMARY KEY (tenant, post_date, chat_id)
+            )
+        ''')
+        
+        # Контрольные точки рассылок: незавершённая рассылка продолжается после перезапуска,
+        # а уже получившие пост чаты пропускаются по sent_posts
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_state (
+                tenant TEXT NOT NULL DEFAULT '',
+                post_date TEXT,
+                status TEXT,
+                post_text TEXT,
+                updated_at TEXT,
+                PRIMARY KEY (tenant, post_date)
+            )
+        ''')
+        
+        # Сводная статистика рассылок по дням
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS delivery_stats (
+                tenant TEXT NOT NULL DEFAULT '',
+                day TEXT,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                pruned INTEGER DEFAULT 0,
+                skipped INTEGER DEFAULT 0,
+                duration_sec REAL DEFAULT 0,
+                generation_mode TEXT,
+                PRIMARY KEY (tenant, day)
+            )
+        ''')
+        
+        # Старые данные переносятся в tenant '' (бот по умолчанию)
+        for table, columns in legacy_tables:
+            column_list = ', '.join(columns)
+            # OR IGNORE: строки, уже записанные в новую таблицу, остаются
+            cursor.execute(
+                f'INSERT OR IGNORE INTO {table} ({column_list}) '
+                f'SELECT {column_list} FROM {table}_legacy'
+            )
+            cursor.execute(f'DROP TABLE {table}_legacy')
+            logger.info(f"🔄 Таблица {table} переведена на многоботовую схему")
     
     def add_chat(self, chat_id: int, chat_title: str, chat_type: str):
         """Добавить чат в базу"""
@@ -97,8 +239,8 @@ class ChatDatabase:
             
             # Проверяем, существует ли уже чат
             cursor.execute(
-                'SELECT chat_id FROM chats WHERE chat_id = ?',
-                (chat_id,)
+                'SELECT chat_id FROM chats WHERE tenant = ? AND chat_id = ?',
+                (self.tenant, chat_id)
             )
             
             if cursor.fetchone():
@@ -106,14 +248,15 @@ class ChatDatabase:
                 cursor.execute('''
                     UPDATE chats 
                     SET chat_title = ?, is_active = 1 
-                    WHERE chat_id = ?
-                ''', (chat_title, chat_id))
+                    WHERE tenant = ? AND chat_id = ?
+                ''', (chat_title, self.tenant, chat_id))
             else:
                 # Добавляем новый чат
                 cursor.execute('''
-                    INSERT INTO chats (chat_id, chat_title, chat_type, added_date)
-                    VALUES (?, ?, ?, ?)
-                ''', (chat_id, chat_title, chat_type, datetime.now().isoformat()))
+                    INSERT INTO chats (tenant, chat_id, chat_title, chat_type, added_date)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (self.tenant, chat_id, chat_title, chat_type,
+                      datetime.now().isoformat()))
             
             conn.commit()
     
@@ -122,8 +265,8 @@ class ChatDatabase:
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             cursor.execute(
-                'UPDATE chats SET is_active = 0 WHERE chat_id = ?',
-                (chat_id,)
+                'UPDATE chats SET is_active = 0 WHERE tenant = ? AND chat_id = ?',
+                (self.tenant, chat_id)
             )
             conn.commit()
     
@@ -134,16 +277,19 @@ class ChatDatabase:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT * FROM chats 
-                WHERE is_active = 1 
+                WHERE tenant = ? AND is_active = 1 
                 ORDER BY added_date DESC
-            ''')
+            ''', (self.tenant,))
             return [dict(row) for row in cursor.fetchall()]
     
     def get_chat_count(self) -> int:
         """Получить количество активных чатов"""
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT COUNT(*) FROM chats WHERE is_active = 1')
+            cursor.execute(
+                'SELECT COUNT(*) FROM chats WHERE tenant = ? AND is_active = 1',
+                (self.tenant,)
+            )
             return cursor.fetchone()[0]
     
     def mark_post_sent(self, chat_id: int, post_date: str, post_hash: str = None):
@@ -154,59 +300,292 @@ class ChatDatabase:
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT OR REPLACE INTO sent_posts (post_date, chat_id, post_hash)
-                VALUES (?, ?, ?)
-            ''', (post_date, chat_id, post_hash))
+                INSERT OR REPLACE INTO sent_posts (tenant, post_date, chat_id, post_hash)
+                VALUES (?, ?, ?, ?)
+            ''', (self.tenant, post_date, chat_id, post_hash))
             
             # Обновляем дату последнего поста в чате
             cursor.execute('''
                 UPDATE chats 
                 SET last_post_date = ? 
-                WHERE chat_id = ?
-            ''', (datetime.now().isoformat(), chat_id))
+                WHERE tenant = ? AND chat_id = ?
+            ''', (datetime.now().isoformat(), self.tenant, chat_id))
+            
+            # Сводка обновляется в той же транзакции, что и сама отметка
+            cursor.execute('''
+                INSERT INTO delivery_stats (tenant, day, sent) VALUES (?, ?, 1)
+                ON CONFLICT(tenant, day) DO UPDATE SET sent = sent + 1
+            ''', (self.tenant, post_date))
             
             conn.commit()
     
-    def was_post_sent_today(self, chat_id: int) -> bool:
-        """Проверка, отправлялся ли сегодня пост в этот чат"""
-        today = datetime.now().strftime('%Y-%m-%d')
+    def was_post_sent(self, chat_id: int, post_date: str) -> bool:
+        """Проверка, отправлялся ли пост за эту дату (московскую) в этот чат"""
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT 1 FROM sent_posts 
-                WHERE chat_id = ? AND post_date = ?
-            ''', (chat_id, today))
+                WHERE tenant = ? AND chat_id = ? AND post_date = ?
+            ''', (self.tenant, chat_id, post_date))
             return cursor.fetchone() is not None
     
-    def clear_old_records(self, days: int = 30):
-        """Очистка старых записей"""
-        cutoff_date = (datetime.now() - timedelta(days=days)).isoformat()
+    def record_broadcast(self, day: str, failed: int = 0, pruned: int = 0,
+                         skipped: int = 0, duration_sec: float = 0,
+                         generation_mode: str = None):
+        """Записать итоги рассылки в сводную статистику дня
+        
+        Повторный запуск за тот же день (продолжение после остановки, /post_now)
+        заново пробует все недоставленные чаты, поэтому failed и skipped
+        последнего запуска заменяют прежние, а не добавляются к ним. Удалённые
+        чаты повторно не пробуются - pruned суммируется.
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO delivery_stats
+                    (tenant, day, failed, pruned, skipped, duration_sec, generation_mode)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(tenant, day) DO UPDATE SET
+                    failed = excluded.failed,
+                    pruned = pruned + excluded.pruned,
+                    skipped = excluded.skipped,
+                    duration_sec = duration_sec + excluded.duration_sec,
+                    generation_mode = COALESCE(excluded.generation_mode, generation_mode)
+            ''', (self.tenant, day, failed, pruned, skipped, duration_sec,
+                  generation_mode))
+            conn.commit()
+    
+    def get_delivery_summary(self, days: int) -> Dict:
+        """Сводка рассылок за последние N дней (читает не более N строк)"""
+        since = (_moscow_now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
         with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
+            cursor.execute('''
+                SELECT COUNT(*) AS days,
+                       COALESCE(SUM(sent), 0) AS sent,
+                       COALESCE(SUM(failed), 0) AS failed,
+                       COALESCE(SUM(pruned), 0) AS pruned,
+                       COALESCE(SUM(skipped), 0) AS skipped,
+                       COALESCE(AVG(duration_sec), 0) AS avg_duration_sec,
+                       SUM(generation_mode = 'API') AS api_days
+                FROM delivery_stats
+                WHERE tenant = ? AND day >= ?
+            ''', (self.tenant, since))
+            summary = dict(cursor.fetchone())
+        summary['api_days'] = summary['api_days'] or 0
+        return summary
+    
+    def save_broadcast_state(self, post_date: str, status: str, post_text: str = None):
+        """Сохранить контрольную точку рассылки: running, interrupted или done"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO broadcast_state
+                    (tenant, post_date, status, post_text, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(tenant, post_date) DO UPDATE SET
+                    status = excluded.status,
+                    post_text = COALESCE(excluded.post_text, post_text),
+                    updated_at = excluded.updated_at
+            ''', (self.tenant, post_date, status, post_text, datetime.now().isoformat()))
+            conn.commit()
+    
+    def get_unfinished_broadcast(self, post_date: str) -> Dict:
+        """Незавершённая рассылка за день (прервана или оборвалась) или None"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM broadcast_state
+                WHERE tenant = ? AND post_date = ? AND status != 'done'
+                    AND post_text IS NOT NULL
+            ''', (self.tenant, post_date))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def clear_old_records(self, days: int = SENT_POSTS_RETENTION_DAYS):
+        """Очистка старых записей (сводная статистика не затрагивается)"""
+        # Ключи post_date - московские даты YYYY-MM-DD, граница считается так же
+        cutoff_date = (_moscow_now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'DELETE FROM sent_posts WHERE tenant = ? AND post_date < ?',
+                (self.tenant, cutoff_date)
+            )
             cursor.execute(
-                'DELETE FROM sent_posts WHERE post_date < ?',
-                (cutoff_date,)
+                'DELETE FROM broadcast_state WHERE tenant = ? AND post_date < ?',
+                (self.tenant, cutoff_date)
             )
             conn.commit()
+    
+    # ------------------------------------------------------------------------
+    # Массовый импорт/экспорт
+    # ------------------------------------------------------------------------
+    
+    def export_table(self, table: str, path: str) -> int:
+        """Потоковый экспорт таблицы в JSONL или CSV (по расширению файла)"""
+        columns = [name for name, _ in TRANSFER_TABLES[table]['columns']]
+        fmt = _transfer_format(path)
+        count = 0
+        
+        with sqlite3.connect(self.db_path) as conn, \
+                open(path, 'w', encoding='utf-8', newline='') as f:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'SELECT {", ".join(columns)} FROM {table} WHERE tenant = ?',
+                (self.tenant,)
+            )
+            
+            if fmt == 'csv':
+                writer = csv.writer(f)
+                writer.writerow(columns)
+            
+            # Курсор отдаёт строки по одной - память не растёт с размером таблицы
+            for row in cursor:
+                if fmt == 'csv':
+                    writer.writerow([CSV_NULL if value is None else value for value in row])
+                else:
+                    f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                    f.write('\n')
+                count += 1
+        
+        return count
+    
+    def import_table(self, table: str, path: str,
+                     chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+        """Импорт таблицы из JSONL/CSV пачками в одной транзакции"""
+        columns = ['tenant'] + [name for name, _ in TRANSFER_TABLES[table]['columns']]
+        placeholders = ', '.join('?' * len(columns))
+        query = (
+            f'INSERT OR REPLACE INTO {table} ({", ".join(columns)}) '
+            f'VALUES ({placeholders})'
+        )
+        count = 0
+        
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            for chunk in _chunked(_read_transfer_rows(table, path), chunk_size):
+                cursor.executemany(query, [(self.tenant,) + row for row in chunk])
+                count += len(chunk)
+            # Один коммит на весь импорт: либо всё, либо ничего
+            conn.commit()
+        
+        return count
+    
+    def verify_table(self, table: str, path: str) -> Tuple[int, int]:
+        """Сверка файла с базой: (проверено строк, расхождений)"""
+        spec = TRANSFER_TABLES[table]
+        columns = [name for name, _ in spec['columns']]
+        key = spec['key']
+        key_positions = [columns.index(name) for name in key]
+        query = (
+            f'SELECT {", ".join(columns)} FROM {table} WHERE tenant = ? AND '
+            + ' AND '.join(f'{name} = ?' for name in key)
+        )
+        checked = 0
+        mismatched = 0
+        
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            for row in _read_transfer_rows(table, path):
+                cursor.execute(query, [self.tenant] + [row[i] for i in key_positions])
+                if cursor.fetchone() != row:
+                    mismatched += 1
+                checked += 1
+        
+        return checked, mismatched
 
-# Инициализация базы данных
-db = ChatDatabase()
+def _transfer_format(path: str) -> str:
+    """Формат файла импорта/экспорта по расширению"""
+    suffix = Path(path).suffix.lower()
+    if suffix == '.csv':
+        return 'csv'
+    if suffix in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    raise ValueError(f"Неизвестный формат файла: {path} (нужен .jsonl или .csv)")
 
-# ============================================================================
-# ИНИЦИАЛИЗАЦИЯ БОТА
-# ============================================================================
+def _read_transfer_rows(table: str, path: str) -> Iterator[Tuple]:
+    """Потоковое чтение строк таблицы из JSONL/CSV
+    
+    Ошибка в любой строке файла прерывает чтение с ValueError, в тексте
+    которой указан номер строки.
+    """
+    spec = TRANSFER_TABLES[table]
+    fmt = _transfer_format(path)
+    
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            records = ((reader.line_num, record) for record in reader)
+        else:
+            records = _read_jsonl_records(f, path)
+        
+        for line_num, record in records:
+            try:
+                yield _transfer_row(spec, record, csv_format=(fmt == 'csv'))
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"{path}, строка {line_num}: {e}") from None
+
+def _read_jsonl_records(f, path: str) -> Iterator[Tuple[int, Dict]]:
+    """Записи JSONL с номерами строк"""
+    for line_num, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path}, строка {line_num}: некорректный JSON ({e})") from None
+        if not isinstance(record, dict):
+            raise ValueError(f"{path}, строка {line_num}: ожидается JSON-объект")
+        yield line_num, record
+
+def _transfer_row(spec: Dict, record: Dict, csv_format: bool) -> Tuple:
+    """Запись файла -> кортеж значений колонок таблицы"""
+    row = []
+    for name, kind in spec['columns']:
+        if name not in record or (csv_format and record[name] is None):
+            # Нет колонки (или ячейки в короткой строке CSV)
+            if name in spec['key']:
+                raise ValueError(f"нет ключевого поля {name}")
+            row.append(spec['defaults'].get(name))
+            continue
+        
+        value = record[name]
+        if csv_format and (value == CSV_NULL or (value == '' and kind is not str)):
+            # В CSV NULL записан как \N; пустое число тоже считаем NULL
+            value = None
+        if isinstance(value, (dict, list)):
+            # Иначе в базу попал бы repr Python-объекта
+            raise ValueError(f"поле {name}: ожидается строка или число, а не {type(value).__name__}")
+        if value is None or (csv_format and name in spec['key'] and value == ''):
+            # NULL в первичном ключе SQLite не уникален - такие строки дублировались бы
+            if name in spec['key']:
+                raise ValueError(f"нет ключевого поля {name}")
+            row.append(None)
+            continue
+        row.append(kind(value))
+    return tuple(row)
 
-bot = Bot(token=TELEGRAM_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
+def _chunked(rows: Iterable[Tuple], size: int) -> Iterator[List[Tuple]]:
+    """Разбить поток строк на пачки фиксированного размера"""
+    iterator = iter(rows)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 # ============================================================================
 # ЛИЧНОСТЬ БОТА
 # ============================================================================
 
-BOT_PERSONALITY = f"""{BOT_NAME} - цифровой историк с ироничным взглядом.
+def make_personality(bot_name: str, post_time: str) -> str:
+    """Описание личности бота для промпта API"""
+    return f"""{bot_name} - цифровой историк с ироничным взглядом.
 
-Я генерирую исторические посты каждый день в 9:00 по Москве!
+Я генерирую исторические посты каждый день в {post_time} по Москве!
 
 Мой стиль:
 🔥 Ироничный, но дружелюбный
@@ -222,12 +601,19 @@ BOT_PERSONALITY = f"""{BOT_NAME} - цифровой историк с ирони
 # ============================================================================
 
 class TextGenerator:
-    """Генератор текстов с несколькими стратегиями"""
+    """Генератор текстов с несколькими стратегиями
+    
+    Один экземпляр и один пул соединений на все боты процесса. Одинаковые
+    запросы к API (та же личность и промпт), выполняющиеся одновременно,
+    объединяются в один; готовые ответы не кэшируются.
+    """
     
     def __init__(self):
         self.templates = self._load_templates()
         self.history = self._load_historical_data()
         self.use_api = bool(OPENAI_API_KEY or HF_TOKEN)
+        self.session: aiohttp.ClientSession = None  # Общий пул соединений, задаётся при запуске
+        self._in_flight: Dict[Tuple[str, str], asyncio.Future] = {}
         logger.info(f"Генератор готов. API: {'доступно' if self.use_api else 'шаблоны'}")
     
     def _load_templates(self) -> Dict:
@@ -321,179 +707,336 @@ class TextGenerator:
         today = datetime.now().strftime("%m-%d")
         return holidays.get(today, "")
     
-    async def generate_with_api(self, prompt: str) -> str:
+    async def generate_with_api(self, prompt: str, personality: str) -> str:
         """Генерация через API (если доступно)"""
         if not self.use_api:
             return None
         
+        key = (personality, prompt)
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._request_api(prompt, personality))
+            self._in_flight[key] = future
+            # Завершённый запрос убираем: следующий вызов получит новый текст
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        
+        # shield: отмена одного ожидающего бота не отменяет запрос для остальных
+        return await asyncio.shield(future)
+    
+    async def _request_api(self, prompt: str, personality: str) -> str:
+        """Запрос к API через общий пул соединений"""
+        session = self.session
+        
         try:
             # OpenAI
             if OPENAI_API_KEY:
-                async with aiohttp.ClientSession() as session:
-                    data = {
-                        "model": "gpt-3.5-turbo",
-                        "messages": [
-                            {"role": "system", "content": BOT_PERSONALITY},
-                            {"role": "user", "content": prompt}
-                        ],
-                        "max_tokens": 150,
-                        "temperature": 0.8
-                    }
+                data = {
+                    "model": "gpt-3.5-turbo",
+                    "messages": [
+                        {"role": "system", "content": personality},
+                        {"role": "user", "content": prompt}
+                    ],
+                    "max_tokens": 150,
+                    "temperature": 0.8
+                }
+                
+                async with session.post(
+                    "https://api.openai.com/v1/chat/completions",
+                    headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+                    json=data,
+                    timeout=10
+                ) as response:
                     
-                    async with session.post(
-                        "https://api.openai.com/v1/chat/completions",
-                        headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
-                        json=data,
-                        timeout=10
-                    ) as response:
-                        
-                        if response.status == 200:
-                            result = await response.json()
-                            return result['choices'][0]['message']['content'].strip()
+                    if response.status == 200:
+                        result = await response.json()
+                        return result['choices'][0]['message']['content'].strip()
             
             # Hugging Face
             elif HF_TOKEN:
-                async with aiohttp.ClientSession() as session:
-                    data = {
-                        "inputs": f"{BOT_PERSONALITY}\n\n{prompt}",
-                        "parameters": {"max_length": 200, "temperature": 0.9}
-                    }
+                data = {
+                    "inputs": f"{personality}\n\n{prompt}",
+                    "parameters": {"max_length": 200, "temperature": 0.9}
+                }
+                
+                async with session.post(
+                    "https://api-inference.huggingface.co/models/microsoft/phi-2",
+                    headers={"Authorization": f"Bearer {HF_TOKEN}"},
+                    json=data,
+                    timeout=10
+                ) as response:
                     
-                    async with session.post(
-                        "https://api-inference.huggingface.co/models/microsoft/phi-2",
-                        headers={"Authorization": f"Bearer {HF_TOKEN}"},
-                        json=data,
-                        timeout=10
-                    ) as response:
-                        
-                        if response.status == 200:
-                            result = await response.json()
-                            return result[0]['generated_text'].split('\n')[0].strip()
+                    if response.status == 200:
+                        result = await response.json()
+                        return result[0]['generated_text'].split('\n')[0].strip()
         
         except Exception as e:
             logger.warning(f"API ошибка: {e}")
         
         return None
 
-# Инициализация генератора
+# Инициализация генератора (общий для всех ботов процесса)
 generator = TextGenerator()
 
+# ============================================================================
+# БОТЫ ПРОЦЕССА
+# ============================================================================
+
+class SharedPoolBot(Bot):
+    """Bot, использующий общий для процесса пул HTTP-соединений"""
+    
+    def __init__(self, token: str, connector: aiohttp.TCPConnector, **kwargs):
+        super().__init__(token=token, **kwargs)
+        self._shared_connector = connector
+    
+    async def get_new_session(self) -> aiohttp.ClientSession:
+        # Сессия не владеет пулом: закрытие одного бота не рвёт соединения остальных
+        return aiohttp.ClientSession(
+            connector=self._shared_connector,
+            connector_owner=False,
+            json_serialize=json.dumps
+        )
+
+class BotTenant:
+    """Один бот (токен) в общем процессе
+    
+    У каждого бота свои Dispatcher, расписание и пауза между отправками;
+    пул соединений, генератор и файл базы данных - общие.
+    """
+    
+    def __init__(self, token: str, connector: aiohttp.TCPConnector,
+                 name: str = BOT_NAME, tenant: str = None,
+                 post_hour: int = 9, post_minute: int = 0,
+                 send_interval: float = 0.5, personality: str = None,
+                 db_path: str = DB_PATH):
+        self.bot = SharedPoolBot(token, connector=connector)
+        self.dp = Dispatcher(self.bot, storage=MemoryStorage())
+        self.name = name
+        self.post_hour = post_hour
+        self.post_minute = post_minute
+        self.send_interval = send_interval
+        self.personality = personality or make_personality(name, self.post_time)
+        # По умолчанию строки бота в общей базе помечаются его ID
+        self.db = ChatDatabase(db_path, tenant=str(self.bot.id) if tenant is None else tenant)
+        self.last_mode = None  # Чем сгенерирован последний пост: 'API' или 'Шаблоны'
+        self.stop_event = asyncio.Event()  # Бот останавливается - новую работу не берём
+        self.broadcast_lock = asyncio.Lock()
+        self.scheduler_task: asyncio.Task = None
+        self.handler_tasks: Set[asyncio.Task] = set()  # Обработчики, выполняющиеся сейчас
+        register_handlers(self.dp)
+    
+    @property
+    def post_time(self) -> str:
+        """Время рассылки для текстов, например 9:00"""
+        return f"{self.post_hour}:{self.post_minute:02d}"
+
+# Запущенные боты по ID бота - обработчики находят по нему своего бота
+TENANTS: Dict[int, BotTenant] = {}
+
+def _tenant(message: types.Message) -> BotTenant:
+    """Бот, получивший сообщение"""
+    return TENANTS[message.bot.id]
+
+def load_tenant_configs() -> List[Dict]:
+    """Список ботов из BOTS_CONFIG или один бот из TELEGRAM_TOKEN"""
+    if not BOTS_CONFIG:
+        # Бот по умолчанию хранит данные в tenant '' - как до многоботовой схемы
+        return [{'token': TELEGRAM_TOKEN, 'name': BOT_NAME, 'tenant': ''}]
+    
+    with open(BOTS_CONFIG, 'r', encoding='utf-8') as f:
+        configs = json.load(f)
+    
+    # Первый бот продолжает работать с прежними данными (tenant '')
+    if configs:
+        configs[0].setdefault('tenant', '')
+    return configs
+
 # ============================================================================
 # ОСНОВНАЯ ЛОГИКА РАССЫЛКИ
 # ============================================================================
 
-async def send_post_to_all_chats():
-    """Отправка поста во все активные чаты"""
+async def send_post_to_all_chats(tenant: BotTenant) -> str:
+    """Отправка поста во все активные чаты бота
+    
+    Возвращает итог: 'done', 'interrupted', 'no_chats', 'no_post', а если
+    рассылка не начиналась - 'not_due', 'busy' или 'stopping'.
+    """
+    db = tenant.db
     
     # Проверяем московское время (UTC+3)
-    utc_now = datetime.utcnow()
-    moscow_time = utc_now + timedelta(hours=3)
+    moscow_time = _moscow_now()
+    post_date = moscow_time.strftime('%Y-%m-%d')
     
-    # Только в 9:00 по Москве
-    if moscow_time.hour != 9 or moscow_time.minute != 0:
-        return
+    # Рассылка, прерванная остановкой бота, продолжается сразу после запуска
+    checkpoint = db.get_unfinished_broadcast(post_date)
+    
+    # Иначе только во время рассылки бота по Москве
+    on_schedule = (moscow_time.hour == tenant.post_hour
+                   and moscow_time.minute == tenant.post_minute)
+    if not checkpoint and not on_schedule:
+        return 'not_due'
     
-    logger.info(f"🕘 {moscow_time.strftime('%H:%M')} МСК - начинаем рассылку")
+    # Во время остановки и параллельно с идущей рассылкой новую не начинаем
+    if tenant.stop_event.is_set():
+        return 'stopping'
+    if tenant.broadcast_lock.locked():
+        return 'busy'
+    
+    async with tenant.broadcast_lock:
+        return await _run_broadcast(tenant, moscow_time, checkpoint)
+
+async def _run_broadcast(tenant: BotTenant, moscow_time: datetime, checkpoint: Dict = None) -> str:
+    """Рассылка с контрольной точкой в базе"""
+    db = tenant.db
+    post_date = moscow_time.strftime('%Y-%m-%d')
+    
+    if checkpoint:
+        logger.info(f"▶️ {tenant.name} продолжает прерванную рассылку за {post_date}")
+    else:
+        logger.info(f"🕘 {moscow_time.strftime('%H:%M')} МСК - {tenant.name} начинает рассылку")
     
     # Получаем все активные чаты
     chats = db.get_all_active_chats()
     if not chats:
         logger.info("Нет активных чатов для рассылки")
-        return
+        if checkpoint:
+            db.save_broadcast_state(post_date, 'done')
+        return 'no_chats'
     
     logger.info(f"Найдено {len(chats)} активных чатов")
+    started = time.monotonic()
     
-    # Генерируем пост один раз для всех чатов
-    post_text = await generate_daily_post()
+    # Генерируем пост один раз для всех чатов (при продолжении - тот же текст)
+    if checkpoint:
+        post_text = checkpoint['post_text']
+        generation_mode = None
+    else:
+        post_text = await generate_daily_post(tenant)
+        generation_mode = tenant.last_mode
     
     if not post_text:
         logger.error("Не удалось сгенерировать пост")
-        return
+        return 'no_post'
+    
+    db.save_broadcast_state(post_date, 'running', post_text=post_text)
     
     # Форматируем пост
-    formatted_post = f"📜 *{BOT_NAME}* 📜\n\n{post_text}\n\n_{moscow_time.strftime('%d.%m.%Y')}_\n#история #цитатадня"
+    formatted_post = f"📜 *{tenant.name}* 📜\n\n{post_text}\n\n_{moscow_time.strftime('%d.%m.%Y')}_\n#история #цитатадня"
     
     # Отправляем во все чаты
     success_count = 0
     fail_count = 0
+    pruned_count = 0
+    processed_count = 0
+    status = 'interrupted'
     
-    for chat in chats:
-        chat_id = chat['chat_id']
-        chat_title = chat['chat_title']
-        
-        # Проверяем, не отправляли ли уже сегодня
-        if db.was_post_sent_today(chat_id):
-            logger.info(f"↪️ Пропускаем {chat_title} - уже отправляли сегодня")
-            continue
-        
-        try:
-            # Пытаемся отправить
-            await bot.send_message(
-                chat_id=chat_id,
-                text=formatted_post,
-                parse_mode="Markdown",
-                disable_notification=False
-            )
-            
-            # Помечаем как отправленное
-            db.mark_post_sent(chat_id, moscow_time.strftime('%Y-%m-%d'))
-            
-            logger.info(f"✅ Отправлено в: {chat_title} (ID: {chat_id})")
-            success_count += 1
-            
-            # Небольшая пауза между отправками
-            await asyncio.sleep(0.5)
+    try:
+        for chat in chats:
+            chat_id = chat['chat_id']
+            chat_title = chat['chat_title']
             
-        except Exception as e:
-            error_msg = str(e).lower()
+            # Бот останавливается - текущая отправка уже завершена, новые не начинаем
+            if tenant.stop_event.is_set():
+                logger.warning(f"⏸️ {tenant.name}: рассылка прервана остановкой бота")
+                break
+            processed_count += 1
             
-            # Анализируем ошибку
-            if "chat not found" in error_msg or "bot was kicked" in error_msg:
-                logger.warning(f"🗑️ Удаляем чат {chat_title} - бота исключили")
-                db.remove_chat(chat_id)
-            elif "not enough rights" in error_msg:
-                logger.warning(f"⚠️ Нет прав в чате {chat_title}")
-            elif "Too Many Requests" in error_msg:
-                logger.warning(f"⏳ Лимит запросов, ждем...")
-                await asyncio.sleep(5)
-            else:
-                logger.error(f"❌ Ошибка отправки в {chat_title}: {e}")
+            # Проверяем, не отправляли ли уже сегодня (в статистике это не пропуск -
+            # доставка уже учтена при первой отправке)
+            if db.was_post_sent(chat_id, post_date):
+                logger.info(f"↪️ Пропускаем {chat_title} - уже отправляли сегодня")
+                continue
             
-            fail_count += 1
-    
-    # Итоги рассылки
-    logger.info(f"📊 Итоги рассылки: {success_count} успешно, {fail_count} ошибок")
+            try:
+                # Пытаемся отправить
+                await tenant.bot.send_message(
+                    chat_id=chat_id,
+                    text=formatted_post,
+                    parse_mode="Markdown",
+                    disable_notification=False
+                )
+                
+                # Помечаем как отправленное
+                db.mark_post_sent(chat_id, post_date)
+                
+                logger.info(f"✅ Отправлено в: {chat_title} (ID: {chat_id})")
+                success_count += 1
+                
+                # Пауза между отправками - у каждого бота свой лимит Telegram
+                await asyncio.sleep(tenant.send_interval)
+                
+            except Exception as e:
+                error_msg = str(e).lower()
+                
+                # Анализируем ошибку
+                if "chat not found" in error_msg or "bot was kicked" in error_msg:
+                    logger.warning(f"🗑️ Удаляем чат {chat_title} - бота исключили")
+                    db.remove_chat(chat_id)
+                    pruned_count += 1
+                elif "not enough rights" in error_msg:
+                    logger.warning(f"⚠️ Нет прав в чате {chat_title}")
+                elif "Too Many Requests" in error_msg:
+                    logger.warning(f"⏳ Лимит запросов, ждем...")
+                    await asyncio.sleep(5)
+                else:
+                    logger.error(f"❌ Ошибка отправки в {chat_title}: {e}")
+                
+                fail_count += 1
+        else:
+            status = 'done'
+    finally:
+        # Пропущенные - чаты, до которых рассылка не дошла из-за остановки
+        skipped_count = len(chats) - processed_count
+        
+        # Контрольная точка и статистика пишутся и при прерывании (в т.ч. отмене задачи)
+        db.save_broadcast_state(post_date, status)
+        
+        # Итоги рассылки
+        logger.info(f"📊 Итоги рассылки {tenant.name}: {success_count} успешно, {fail_count} ошибок")
+        
+        # Успешные отправки уже учтены в mark_post_sent; удалённые чаты - отдельно от ошибок
+        db.record_broadcast(
+            post_date,
+            failed=fail_count - pruned_count,
+            pruned=pruned_count,
+            skipped=skipped_count,
+            duration_sec=time.monotonic() - started,
+            generation_mode=generation_mode
+        )
     
-    # Очистка старых записей раз в неделю
-    if moscow_time.weekday() == 0:  # Понедельник
+    if status == 'done':
+        # Построчная история нужна только для защиты от дублей - чистим после каждой рассылки
         db.clear_old_records()
         logger.info("🧹 Выполнена очистка старых записей")
+    
+    return status
 
-async def generate_daily_post() -> str:
+async def generate_daily_post(tenant: BotTenant) -> str:
     """Генерация поста с приоритетом API"""
     
     # Пытаемся использовать API
     if generator.use_api:
         api_prompt = "Напиши короткий ироничный исторический пост на утро. 1-2 предложения."
-        api_text = await generator.generate_with_api(api_prompt)
+        api_text = await generator.generate_with_api(api_prompt, tenant.personality)
         
         if api_text:
+            tenant.last_mode = 'API'
             return api_text
     
     # Используем шаблоны как запасной вариант
+    tenant.last_mode = 'Шаблоны'
     return await generator.generate_daily_post()
 
 # ============================================================================
 # КОМАНДЫ БОТА
 # ============================================================================
 
-@dp.message_handler(Command('start', 'help'))
 async def cmd_start(message: types.Message):
     """Приветственное сообщение"""
+    tenant = _tenant(message)
     welcome_text = f"""
-🤖 *{BOT_NAME}*
+🤖 *{tenant.name}*
 
-Привет! Я бот, который каждый день в 9:00 по Москве присылаю интересные исторические посты с ироничным взглядом.
+Привет! Я бот, который каждый день в {tenant.post_time} по Москве присылаю интересные исторические посты с ироничным взглядом.
 
 *Как использовать:*
 1. Добавьте меня в группу или канал
@@ -513,10 +1056,9 @@ async def cmd_start(message: types.Message):
 """
     await message.answer(welcome_text, parse_mode="Markdown")
 
-@dp.message_handler(Command('chats'))
 async def cmd_chats(message: types.Message):
     """Показать все чаты"""
-    chats = db.get_all_active_chats()
+    chats = _tenant(message).db.get_all_active_chats()
     
     if not chats:
         await message.answer("📭 Я ещё не добавлен ни в один чат.")
@@ -540,20 +1082,20 @@ async def cmd_chats(message: types.Message):
     
     await message.answer(response, parse_mode="Markdown")
 
-@dp.message_handler(Command('test'))
 async def cmd_test(message: types.Message):
     """Тестовая отправка поста в этот чат"""
+    tenant = _tenant(message)
     if message.chat.type == 'private':
         await message.answer("Эта команда работает только в группах и каналах!")
         return
     
     await message.answer("🧪 Генерирую тестовый пост...")
     
-    post_text = await generate_daily_post()
-    formatted_post = f"📜 *Тестовый пост от {BOT_NAME}* 📜\n\n{post_text}\n\n#тест"
+    post_text = await generate_daily_post(tenant)
+    formatted_post = f"📜 *Тестовый пост от {tenant.name}* 📜\n\n{post_text}\n\n#тест"
     
     try:
-        await bot.send_message(
+        await tenant.bot.send_message(
             chat_id=message.chat.id,
             text=formatted_post,
             parse_mode="Markdown"
@@ -562,28 +1104,29 @@ async def cmd_test(message: types.Message):
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
-@dp.message_handler(Command('stop'))
 async def cmd_stop(message: types.Message):
     """Остановить рассылку в этом чате"""
     if message.chat.type == 'private':
         await message.answer("Эта команда работает только в группах и каналах!")
         return
     
-    db.remove_chat(message.chat.id)
+    _tenant(message).db.remove_chat(message.chat.id)
     await message.answer(
         "✅ Рассылка остановлена в этом чате.\n"
         "Чтобы возобновить, просто напишите /start"
     )
 
-@dp.message_handler(Command('stats'))
 async def cmd_stats(message: types.Message):
     """Статистика бота"""
+    tenant = _tenant(message)
+    db = tenant.db
     chat_count = db.get_chat_count()
-    utc_now = datetime.utcnow()
-    moscow_time = utc_now + timedelta(hours=3)
+    week = db.get_delivery_summary(7)
+    month = db.get_delivery_summary(30)
+    moscow_time = _moscow_now()
     
     stats_text = f"""
-📊 *Статистика {BOT_NAME}*
+📊 *Статистика {tenant.name}*
 
 *Общее:*
 • Активных чатов: {chat_count}
@@ -591,9 +1134,16 @@ async def cmd_stats(message: types.Message):
 • Дата: {moscow_time.strftime('%d.%m.%Y')}
 • Режим генерации: {'API' if generator.use_api else 'Шаблоны'}
 
+*Рассылки за 7 дней:*
+{_format_delivery_summary(week)}
+
+*Рассылки за 30 дней:*
+{_format_delivery_summary(month)}
+• Тренд (в день, 7 vs 30 дней): {_delivery_trend(week, month)}
+
 *Ближайшая рассылка:*
-• Ежедневно в 9:00 по Москве
-• Следующая через: {_next_post_in(moscow_time)}
+• Ежедневно в {tenant.post_time} по Москве
+• Следующая через: {_next_post_in(moscow_time, tenant.post_hour, tenant.post_minute)}
 
 *Команды управления:*
 /chats - список чатов
@@ -604,9 +1154,32 @@ async def cmd_stats(message: types.Message):
     
     await message.answer(stats_text, parse_mode="Markdown")
 
-def _next_post_in(moscow_time: datetime) -> str:
+def _format_delivery_summary(summary: Dict) -> str:
+    """Строки статистики рассылок за период"""
+    return (
+        f"• Отправлено: {summary['sent']}, ошибок: {summary['failed']}\n"
+        f"• Удалено чатов: {summary['pruned']}, не дошли из-за остановки: {summary['skipped']}\n"
+        f"• Дней с рассылкой: {summary['days']} (через API: {summary['api_days']})\n"
+        f"• Средняя длительность: {summary['avg_duration_sec']:.1f} с"
+    )
+
+def _delivery_trend(week: Dict, month: Dict) -> str:
+    """Сравнение среднесуточных отправок за 7 и 30 дней"""
+    week_avg = week['sent'] / 7
+    month_avg = month['sent'] / 30
+    
+    if week_avg > month_avg:
+        arrow = '📈'
+    elif week_avg < month_avg:
+        arrow = '📉'
+    else:
+        arrow = '➡️'
+    
+    return f"{week_avg:.1f} vs {month_avg:.1f} {arrow}"
+
+def _next_post_in(moscow_time: datetime, hour: int = 9, minute: int = 0) -> str:
     """Время до следующей рассылки"""
-    next_post = moscow_time.replace(hour=9, minute=0, second=0, microsecond=0)
+    next_post = moscow_time.replace(hour=hour, minute=minute, second=0, microsecond=0)
     
     if moscow_time >= next_post:
         next_post += timedelta(days=1)
@@ -617,7 +1190,6 @@ def _next_post_in(moscow_time: datetime) -> str:
     
     return f"{hours}ч {minutes}м"
 
-@dp.message_handler(Command('post_now'))
 async def cmd_post_now(message: types.Message):
     """Отправить пост прямо сейчас (для админов)"""
     # Проверка на админа (можно настроить список ID)
@@ -633,22 +1205,25 @@ async def cmd_post_now(message: types.Message):
     await message.answer("🚀 Отправляю пост во все чаты...")
     
     # Запускаем рассылку
-    await send_post_to_all_chats()
+    status = await send_post_to_all_chats(_tenant(message))
     
-    await message.answer("✅ Рассылка завершена!")
+    if status in ('done', 'no_chats'):
+        await message.answer("✅ Рассылка завершена!")
+    else:
+        await message.answer(f"⚠️ Рассылка не выполнена: {POST_NOW_SKIPPED.get(status, status)}")
 
-@dp.message_handler(content_types=['new_chat_members'])
 async def on_new_chat_members(message: types.Message):
     """Когда бота добавляют в чат"""
+    tenant = _tenant(message)
     new_members = message.new_chat_members
     
     for member in new_members:
-        if member.id == bot.id:
+        if member.id == tenant.bot.id:
             # Бота добавили в чат
             chat_title = message.chat.title or f"Чат {message.chat.id}"
             
             # Добавляем чат в базу
-            db.add_chat(
+            tenant.db.add_chat(
                 chat_id=message.chat.id,
                 chat_title=chat_title,
                 chat_type=message.chat.type
@@ -656,9 +1231,9 @@ async def on_new_chat_members(message: types.Message):
             
             # Приветственное сообщение
             welcome_msg = (
-                f"📜 *{BOT_NAME} добавлен в чат!* 📜\n\n"
+                f"📜 *{tenant.name} добавлен в чат!* 📜\n\n"
                 f"Приветствую, {chat_title}! 🎉\n\n"
-                f"Я буду присылать исторические посты каждый день в 9:00 по Москве.\n\n"
+                f"Я буду присылать исторические посты каждый день в {tenant.post_time} по Москве.\n\n"
                 f"*Команды в этом чате:*\n"
                 f"/test - тестовый пост\n"
                 f"/stop - остановить рассылку\n\n"
@@ -666,7 +1241,7 @@ async def on_new_chat_members(message: types.Message):
             )
             
             try:
-                await bot.send_message(
+                await tenant.bot.send_message(
                     chat_id=message.chat.id,
                     text=welcome_msg,
                     parse_mode="Markdown"
@@ -674,72 +1249,290 @@ async def on_new_chat_members(message: types.Message):
             except Exception as e:
                 logger.error(f"Не удалось отправить приветствие: {e}")
 
-@dp.message_handler(content_types=['left_chat_member'])
 async def on_left_chat_member(message: types.Message):
     """Когда бота исключают из чата"""
+    tenant = _tenant(message)
     left_member = message.left_chat_member
     
-    if left_member.id == bot.id:
+    if left_member.id == tenant.bot.id:
         # Бота исключили из чата
-        db.remove_chat(message.chat.id)
-        logger.info(f"Бота исключили из чата {message.chat.id}")
+        tenant.db.remove_chat(message.chat.id)
+        logger.info(f"{tenant.name}: бота исключили из чата {message.chat.id}")
+
+# Почему /post_now не разослал пост
+POST_NOW_SKIPPED = {
+    'not_due': "сейчас не время рассылки",
+    'busy': "рассылка уже идёт",
+    'stopping': "бот останавливается",
+    'interrupted': "прервана остановкой бота, продолжится после запуска",
+    'no_post': "не удалось сгенерировать пост",
+}
+
+def _tracked(handler):
+    """Обработчик, выполнение которого бот дожидается при остановке"""
+    @functools.wraps(handler)
+    async def wrapper(message: types.Message):
+        tenant = _tenant(message)
+        task = asyncio.current_task()
+        tenant.handler_tasks.add(task)
+        try:
+            return await handler(message)
+        finally:
+            tenant.handler_tasks.discard(task)
+    return wrapper
+
+def register_handlers(dp: Dispatcher):
+    """Регистрация обработчиков в Dispatcher бота"""
+    dp.register_message_handler(_tracked(cmd_start), Command('start', 'help'))
+    dp.register_message_handler(_tracked(cmd_chats), Command('chats'))
+    dp.register_message_handler(_tracked(cmd_test), Command('test'))
+    dp.register_message_handler(_tracked(cmd_stop), Command('stop'))
+    dp.register_message_handler(_tracked(cmd_stats), Command('stats'))
+    dp.register_message_handler(_tracked(cmd_post_now), Command('post_now'))
+    dp.register_message_handler(_tracked(on_new_chat_members), content_types=['new_chat_members'])
+    dp.register_message_handler(_tracked(on_left_chat_member), content_types=['left_chat_member'])
 
 # ============================================================================
 # ФОНОВЫЙ ПЛАНИРОВЩИК
 # ============================================================================
 
-async def background_scheduler():
-    """Фоновый планировщик для рассылки"""
-    logger.info("⏰ Планировщик запущен")
+async def background_scheduler(tenant: BotTenant):
+    """Фоновый планировщик для рассылки бота"""
+    logger.info(f"⏰ Планировщик {tenant.name} запущен")
     
-    while True:
+    while not tenant.stop_event.is_set():
         try:
-            await send_post_to_all_chats()
-            await asyncio.sleep(55)  # Проверяем каждые 55 секунд
+            await send_post_to_all_chats(tenant)
+            # Проверяем каждые 55 секунд, но просыпаемся сразу при остановке
+            await asyncio.wait_for(tenant.stop_event.wait(), timeout=55)
+        except asyncio.TimeoutError:
+            continue
         except asyncio.CancelledError:
             break
         except Exception as e:
-            logger.error(f"Ошибка планировщика: {e}")
-            await asyncio.sleep(60)
+            logger.error(f"Ошибка планировщика {tenant.name}: {e}")
+            # Пауза после ошибки тоже прерывается остановкой бота
+            try:
+                await asyncio.wait_for(tenant.stop_event.wait(), timeout=60)
+            except asyncio.TimeoutError:
+                pass
+    
+    logger.info(f"⏰ Планировщик {tenant.name} остановлен")
 
 # ============================================================================
 # ЗАПУСК И ОСТАНОВКА
 # ============================================================================
 
-async def on_startup(_):
-    """Действия при запуске"""
+async def on_startup(tenants: List[BotTenant]) -> List[BotTenant]:
+    """Действия при запуске; возвращает ботов, которые запустились"""
     logger.info("=" * 50)
-    logger.info(f"🚀 {BOT_NAME} запускается...")
-    logger.info(f"📊 Активных чатов: {db.get_chat_count()}")
     logger.info(f"⚙️ Режим генерации: {'API' if generator.use_api else 'Шаблоны'}")
+    
+    started = []
+    for tenant in tenants:
+        logger.info(f"🚀 {tenant.name} запускается... (рассылка в {tenant.post_time} МСК)")
+        try:
+            # Отозванный токен даёт ошибку здесь - остальные боты продолжают запуск
+            await tenant.dp.skip_updates()
+        except Exception as e:
+            logger.error(f"❌ {tenant.name} не запущен: {e}")
+            continue
+        
+        logger.info(f"📊 Активных чатов: {tenant.db.get_chat_count()}")
+        # Запускаем планировщик - у каждого бота своё расписание
+        tenant.scheduler_task = asyncio.create_task(background_scheduler(tenant))
+        started.append(tenant)
+    
     logger.info("=" * 50)
+    return started
+
+async def on_shutdown(tenants: List[BotTenant], polling_tasks: List[asyncio.Task]):
+    """Остановка с дожиданием текущей работы не дольше SHUTDOWN_DRAIN_TIMEOUT"""
+    logger.info(f"Останавливаем ботов (ожидание до {SHUTDOWN_DRAIN_TIMEOUT:g} с)...")
+    
+    # 1. Новую работу не принимаем: останавливаем опрос Telegram и планировщики
+    for tenant in tenants:
+        tenant.stop_event.set()
+    for task in polling_tasks:
+        task.cancel()
+    await asyncio.gather(*polling_tasks, return_exceptions=True)
+    
+    # 2. Даём завершиться работе самих ботов: планировщикам с их рассылками,
+    #    обработчикам команд и запросам к API генерации. Чужие задачи процесса
+    #    (в том числе ту, что ждёт run_tenants) не трогаем
+    current = asyncio.current_task()
+    owned = [tenant.scheduler_task for tenant in tenants if tenant.scheduler_task]
+    for tenant in tenants:
+        owned.extend(tenant.handler_tasks)
+    owned.extend(generator._in_flight.values())
+    pending = [task for task in owned if task is not current and not task.done()]
+    if pending:
+        _, pending = await asyncio.wait(pending, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    
+    if pending:
+        # Прерванная рассылка сохранит контрольную точку и продолжится после запуска
+        logger.warning(f"⏱️ Время ожидания истекло, отменяем задач: {len(pending)}")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    
+    # 3. Закрываем хранилища и HTTP-сессии ботов
+    for tenant in tenants:
+        await tenant.dp.storage.close()
+        await tenant.dp.storage.wait_closed()
+        await tenant.bot.close()
+    
+    logger.info("Боты остановлены")
+
+async def run_tenants(configs: List[Dict]):
+    """Запуск всех ботов в одном цикле событий с общим пулом соединений"""
+    # Long-poll каждого бота не должен отнимать соединения у отправок
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE + len(configs))
+    generator.session = aiohttp.ClientSession(connector=connector, connector_owner=False)
+    
+    tenants = []
+    for config in configs:
+        try:
+            tenant = BotTenant(connector=connector, **config)
+        except Exception as e:
+            # Ошибка в записи одного бота (например, неверный токен) не мешает остальным
+            logger.error(f"❌ Бот {config.get('name', '?')} пропущен: {e}")
+            continue
+        TENANTS[tenant.bot.id] = tenant
+        tenants.append(tenant)
+    
+    # SIGTERM (деплой, перезапуск) и Ctrl+C запускают штатную остановку
+    shutdown_requested = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, shutdown_requested.set)
+        except NotImplementedError:
+            # Windows: остаётся KeyboardInterrupt
+            pass
+    
+    polling_tasks = []
+    try:
+        started = await on_startup(tenants)
+        polling_tasks = [
+            asyncio.create_task(tenant.dp.start_polling(timeout=60, relax=0.1))
+            for tenant in started
+        ]
+        if started:
+            await shutdown_requested.wait()
+        else:
+            logger.error("❌ Ни один бот не запустился")
+    finally:
+        await on_shutdown(tenants, polling_tasks)
+        await generator.session.close()
+        await connector.close()
+
+async def benchmark_tenants(count: int) -> Dict:
+    """Замер памяти Python на каждого добавленного бота"""
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE + count)
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+        tenants = []
+        
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        
+        for i in range(count):
+            tenant = BotTenant(
+                token=f"{100000 + i}:BENCH{'x' * 30}",
+                connector=connector,
+                name=f"Бот {i}",
+                tenant=f"bench-{i}",
+                db_path=db_path
+            )
+            # Сессия создаётся как при первом запросе к Telegram
+            await tenant.bot.get_session()
+            tenants.append(tenant)
+        
+        total = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        
+        for tenant in tenants:
+            await tenant.bot.close()
+    await connector.close()
     
-    # Запускаем планировщик
-    asyncio.create_task(background_scheduler())
+    return {
+        'bots': count,
+        'total_kb': total / 1024,
+        'per_bot_kb': total / 1024 / count,
+    }
 
-async def on_shutdown(_):
-    """Действия при остановке"""
-    logger.info("Останавливаем бота...")
-    await bot.close()
+# ============================================================================
+# КОНСОЛЬНЫЕ КОМАНДЫ
+# ============================================================================
+
+def run_cli(argv: List[str]) -> int:
+    """Консольные команды: export|import|verify <таблица> <файл>, bench-tenants"""
+    parser = argparse.ArgumentParser(prog='main.py')
+    commands = parser.add_subparsers(dest='action', required=True)
+    
+    for action in ('export', 'import', 'verify'):
+        command = commands.add_parser(action)
+        command.add_argument('table', choices=sorted(TRANSFER_TABLES))
+        command.add_argument('path', help="файл .jsonl или .csv")
+        command.add_argument('--tenant', default='', help="бот (tenant) в общей базе")
+    
+    bench = commands.add_parser('bench-tenants', help="замер памяти на одного бота")
+    bench.add_argument('--count', type=int, default=20)
+    
+    args = parser.parse_args(argv)
+    
+    if args.action == 'bench-tenants':
+        result = asyncio.run(benchmark_tenants(args.count))
+        logger.info(
+            f"🧪 {result['bots']} ботов: {result['total_kb']:.0f} КБ, "
+            f"{result['per_bot_kb']:.1f} КБ на бота"
+        )
+        return 0
+    
+    db = ChatDatabase(DB_PATH, tenant=args.tenant)
+    started = datetime.now()
+    
+    try:
+        if args.action == 'export':
+            count = db.export_table(args.table, args.path)
+            logger.info(f"📤 Экспортировано {count} строк из {args.table} в {args.path}")
+            return 0
+        
+        if args.action == 'import':
+            # При ошибке в файле транзакция откатывается целиком
+            count = db.import_table(args.table, args.path)
+            logger.info(f"📥 Импортировано {count} строк в {args.table} из {args.path}")
+        
+        # Проверочный проход выполняется и после импорта
+        checked, mismatched = db.verify_table(args.table, args.path)
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ {args.action} {args.table}: {e}")
+        return 1
+    
+    elapsed = (datetime.now() - started).total_seconds()
+    
+    if mismatched:
+        logger.error(f"❌ Сверка {args.table}: {mismatched} из {checked} строк не совпадают")
+        return 1
+    
+    logger.info(f"✅ Сверка {args.table}: {checked} строк совпадают ({elapsed:.1f} с)")
+    return 0
 
 # ============================================================================
 # ТОЧКА ВХОДА
 # ============================================================================
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+    
     logger.info("Запуск универсального бота...")
     
     try:
-        executor.start_polling(
-            dp,
-            skip_updates=True,
-            on_startup=on_startup,
-            on_shutdown=on_shutdown,
-            timeout=60,
-            relax=0.1
-        )
+        asyncio.run(run_tenants(load_tenant_configs()))
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}", exc_info=True)
-